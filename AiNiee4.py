@@ -30,13 +30,15 @@ import os
 import sys
 import multiprocessing
 import concurrent.futures
+import collections
 import shutil
 import zipfile
 
-import tiktoken_ext  #必须导入这两个库，否则打包后无法运行
-from tiktoken_ext import openai_public
+# 打包后必须导入这两个库，否则无法运行（这里会连带导入tiktoken）；源码运行时tiktoken在首次计算tokens时才导入
+if getattr(sys, 'frozen', False):
+    import tiktoken_ext
+    from tiktoken_ext import openai_public
 
-import tiktoken #需要安装库pip install tiktoken
 import openpyxl  #需安装库pip install openpyxl
 from openpyxl import Workbook  
 import numpy as np   #需要安装库pip install numpy
@@ -116,6 +118,9 @@ class Translator():
         # ——————————————————————————————————————————构建并发任务池子—————————————————————————————————————————
 
 
+        # 批量预计算待翻译文本的tokens数
+        Request_Limiter.precompute_token_counts(self, cache_list)
+
         # 计算待翻译的文本总行数，tokens总数
         untranslated_text_line_count,untranslated_text_tokens_count = Cache_Manager.count_and_update_translation_status_0_2(self, cache_list) #获取需要翻译的文本总行数
         # 计算并发任务数
@@ -5220,13 +5225,24 @@ Third: Begin translating line by line from the original text, only translating {
 
 # 请求限制器
 class Request_Limiter():
+    # tokens计算用的编码器，键为编码名，同名编码器只构建一次，所有调用共享
+    encoders = {}
+
+    # 原文tokens数缓存，键为文本内容，值为tokens数，所有实例共享；每次翻译开始时按当前项目重建，不会跨项目累积
+    token_cache = {}
+
+    # 请求消息tokens数缓存，只保留最近使用的条目，与原文缓存分开，避免每次请求都不同的内容挤掉原文
+    message_token_cache = collections.OrderedDict()
+    message_token_cache_limit = 1024
+    message_token_cache_lock = threading.Lock()
+
     def __init__(self):
 
         # TPM相关参数
         self.max_tokens = 0  # 令牌桶最大容量
         self.remaining_tokens = 0 # 令牌桶剩余容量
         self.tokens_rate = 0 # 令牌每秒的恢复速率
-        self.last_time = time.time() # 上次记录时间
+        self.last_time = time.monotonic() # 上次记录时间，使用单调时钟，不受系统时间调整影响
 
         # RPM相关参数
         self.last_request_time = 0  # 上次记录时间
@@ -5459,71 +5475,134 @@ class Request_Limiter():
         self.request_interval =request_interval  # 请求的最小时间间隔（s）
 
 
-    def RPM_limit(self):
-        with self.lock:
-            current_time = time.time() # 获取现在的时间
-            time_since_last_request = current_time - self.last_request_time # 计算当前时间与上次记录时间的间隔
-            if time_since_last_request < self.request_interval: 
-                # print("[DEBUG] Request limit exceeded. Please try again later.")
-                return False
-            else:
-                self.last_request_time = current_time
-                return True
-
+    # 检查是否同时符合RPM与TPM限制，符合则记录请求时间并扣除令牌桶里的令牌数
+    def RPM_and_TPM_limit(self, tokens):
+        # 锁被其他线程占用时直接返回，调用方会稍后重试，避免所有线程排队等待
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            now = time.monotonic() # 获取现在的时间
 
+            # 恢复令牌桶：现在时间减去上一次记录的时间，乘以恢复速率，得出这段时间恢复的tokens数量，且不超过最大容量
+            tokens_to_add = (now - self.last_time) * self.tokens_rate
+            self.remaining_tokens = min(self.max_tokens, self.remaining_tokens + tokens_to_add)
+            self.last_time = now # 改变上次记录时间
 
-    def TPM_limit(self, tokens):
-        now = time.time() # 获取现在的时间
-        tokens_to_add = (now - self.last_time) * self.tokens_rate #现在时间减去上一次记录的时间，乘以恢复速率，得出这段时间恢复的tokens数量
-        self.remaining_tokens = min(self.max_tokens, self.remaining_tokens + tokens_to_add) #计算新的剩余容量，与最大容量比较，谁小取谁值，避免发送信息超过最大容量
-        self.last_time = now # 改变上次记录时间
+            # 检查与上次请求的间隔是否符合RPM限制
+            if now - self.last_request_time < self.request_interval:
+                return False
 
-        if tokens > self.remaining_tokens:
-            #print("[DEBUG] 已超过剩余tokens：", tokens,'\n' )
-            return False
-        else:
-           # print("[DEBUG] 数量足够，剩余tokens：", tokens,'\n' )
-            return True
+            # 检查剩余tokens是否符合TPM限制
+            if tokens > self.remaining_tokens:
+                return False
 
-    def RPM_and_TPM_limit(self, tokens):
-        if self.RPM_limit() and self.TPM_limit(tokens):
-            # 如果能够发送请求，则扣除令牌桶里的令牌数
+            # 两项限制都符合，记录请求时间并扣除令牌
+            self.last_request_time = now
             self.remaining_tokens = self.remaining_tokens - tokens
             return True
-        else:
-            return False
+        finally:
+            self.lock.release()
+
 
 
+    # 获取tokens编码器，首次调用时才构建，之后直接复用
+    def get_encoder(self, name = "cl100k_base"):
+        encoder = Request_Limiter.encoders.get(name)
+        if encoder is None:
+            import tiktoken #需要安装库pip install tiktoken
+            encoder = tiktoken.get_encoding(name)
+            Request_Limiter.encoders[name] = encoder
+        return encoder
+
 
     # 计算消息列表内容的tokens的函数
     def num_tokens_from_messages(self,messages):
         """Return the number of tokens used by a list of messages."""
-        try:
-            encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        except KeyError:
-            print("Warning: model not found. Using cl100k_base encoding.")
-            encoding = tiktoken.get_encoding("cl100k_base")
+        encoding = Request_Limiter.get_encoder(self)
 
         tokens_per_message = 3
         tokens_per_name = 1
         num_tokens = 0
+        texts = []
         for message in messages:
             num_tokens += tokens_per_message
             for key, value in message.items():
                 #如果value是字符串类型才计算tokens，否则跳过，因为AI在调用函数时，会在content中回复null，导致报错
                 if isinstance(value, str):
-                    num_tokens += len(encoding.encode(value))
+                    texts.append(value)
                 if key == "name":
                     num_tokens += tokens_per_name
+
+        # 系统提示词与翻译示例等重复发送的内容从缓存中获取，未缓存的文本逐条编码；每次请求只有几条文本，批量编码创建线程池的开销反而更大
+        message_token_cache = Request_Limiter.message_token_cache
+        for text in texts:
+            with Request_Limiter.message_token_cache_lock:
+                text_tokens = message_token_cache.get(text)
+                if text_tokens is not None:
+                    message_token_cache.move_to_end(text)
+
+            if text_tokens is None:
+                text_tokens = len(encoding.encode(text))
+                with Request_Limiter.message_token_cache_lock:
+                    message_token_cache[text] = text_tokens
+                    # 超出上限时淘汰最久未使用的条目
+                    while len(message_token_cache) > Request_Limiter.message_token_cache_limit:
+                        message_token_cache.popitem(last=False)
+
+            num_tokens += text_tokens
         num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
         return num_tokens
 
 
+    # 批量预计算缓存数据中待翻译文本的tokens数量，并以此重建原文tokens缓存
+    def precompute_token_counts(self,cache_list):
+        old_token_cache = Request_Limiter.token_cache
+        token_cache = {}
+        texts = []
+        for entry in cache_list:
+            translation_status = entry.get('translation_status')
+            source_text = entry.get('source_text')
+
+            # 只计算未翻译与正在翻译的文本，已经计算过的直接沿用，重复的文本只计算一次
+            if (translation_status == 0 or translation_status == 2) and isinstance(source_text, str):
+                if source_text in token_cache:
+                    continue
+                num_tokens = old_token_cache.get(source_text)
+                token_cache[source_text] = num_tokens
+                if num_tokens is None:
+                    texts.append(source_text)
+
+        if texts:
+            Request_Limiter.count_tokens_parallel(self,texts,token_cache)
+
+        # 整体替换缓存，统计与截取待翻译文本时直接使用这些tokens数，上一个项目的文本也随之释放
+        Request_Limiter.token_cache = token_cache
+
+
+    # 分块后交给线程池并行计算tokens数，结果写入token_cache
+    def count_tokens_parallel(self,texts,token_cache):
+        # tiktoken编码时会释放GIL，所以多个线程能同时利用多个核心
+        encoder = Request_Limiter.get_encoder(self)
+        chunk_size = 4096
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+
+        # 计算一块文本的tokens数
+        def count_chunk(chunk):
+            return [len(encoder.encode(text)) for text in chunk]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for chunk, counts in zip(chunks, executor.map(count_chunk, chunks)):
+                for text, num_tokens in zip(chunk, counts):
+                    token_cache[text] = num_tokens
+
+
     # 计算单个字符串tokens数量函数
     def num_tokens_from_string(self,string):
         """Returns the number of tokens in a text string."""
-        encoding = tiktoken.get_encoding("cl100k_base")
-        num_tokens = len(encoding.encode(string))
+        num_tokens = Request_Limiter.token_cache.get(string)
+        if num_tokens is None:
+            num_tokens = len(Request_Limiter.get_encoder(self).encode(string))
+            Request_Limiter.token_cache[string] = num_tokens
         return num_tokens
 
 
@@ -5764,6 +5843,10 @@ class User_Interface_Prompter(QObject):
 
 # 文件读取器
 class File_Reader():
+    # Lrc文件的标题标签与时间戳匹配规则
+    LRC_TITLE_PATTERN = re.compile(r'\[ti:(.*?)\]')
+    LRC_TIMESTAMP_PATTERN = re.compile(r'\[(?P<timestamp>[0-9:.]+)\](?P<lyric>.*)')
+
     def __init__(self):
         pass
 
@@ -6200,18 +6283,16 @@ class File_Reader():
                     for line in lyrics:
 
                         # 使用正则表达式匹配标题标签行
-                        title_pattern = re.compile(r'\[ti:(.*?)\]')
-                        match = title_pattern.search(line)
+                        match = File_Reader.LRC_TITLE_PATTERN.search(line)
                         if match:
                             subtitle_title =  match.group(1)  # 返回匹配到的标题全部内容
 
 
                         # 使用正则表达式匹配时间戳和歌词内容
-                        pattern = re.compile(r'(\[([0-9:.]+)\])(.*)')
-                        match = pattern.match(line)
+                        match = File_Reader.LRC_TIMESTAMP_PATTERN.match(line)
                         if match:
-                            timestamp = match.group(2)
-                            source_text = match.group(3).strip()
+                            timestamp = match.group('timestamp')
+                            source_text = match.group('lyric').strip()
                             if source_text == "":
                                 continue
                             storage_path = os.path.relpath(file_path, folder_path)
@@ -6281,14 +6362,18 @@ class File_Reader():
                     # 切行
                     lines = content.split('\n')
 
+                    # 预先计算每一行是否为空行，避免向后查看时重复去除空白
+                    blank_lines = [line.strip() == '' for line in lines]
+                    last_index = len(lines) - 1
+
 
                     for j, line in enumerate(lines):
-                        if line.strip() == '': # 跳过空行
+                        if blank_lines[j]: # 跳过空行
                             continue
                         spaces = len(line) - len(line.lstrip()) # 获取行开头的空格数
 
-                        if j < len(lines) - 1 and lines[j + 1].strip() == '': # 检查当前行是否是文本中的最后一行,并检测下一行是否为空行
-                            if (j+1) < len(lines) - 1 and lines[j + 2].strip() == '': # 再检查下下行是否为空行，所以最多只会保留2行空行信息
+                        if j < last_index and blank_lines[j + 1]: # 检查当前行是否是文本中的最后一行,并检测下一行是否为空行
+                            if (j+1) < last_index and blank_lines[j + 2]: # 再检查下下行是否为空行，所以最多只会保留2行空行信息
                                 # 将数据存储在字典中
                                 json_data_list.append({
                                     "text_index": i,
@@ -6500,6 +6585,9 @@ class Cache_Manager():
     等等
 
     """
+    # <SG 左边:右边>标签匹配，一次捕获冒号左边内容、冒号与冒号右边内容
+    SG_TAG_PATTERN = re.compile(r'<SG([^>:]*)(:)?([^>]*)>')
+
     def __init__(self):
         pass
 
@@ -6537,26 +6625,23 @@ class Cache_Manager():
 
             #加个检测后缀为MP3，wav，png，这些文件名的文本，都是纯代码文本，所以忽略掉
             if source_text:
-                if source_text.endswith('.mp3') or source_text.endswith('.wav') or source_text.endswith('.png') or source_text.endswith('.jpg'):
+                if source_text.endswith(('.mp3', '.wav', '.png', '.jpg')):
                     entry['translation_status'] = 7
 
             
-            # 检查文本是否为空
-            if source_text:
+            # 检查文本是否为空，且含有<SG标签才进行正则匹配
+            if source_text and '<SG' in source_text:
                 # 正则表达式匹配<sg ?: ?>>格式的文本
-                pattern = r'<SG[^>]*>'
-                matches = re.findall(pattern, source_text)
+                matches = Cache_Manager.SG_TAG_PATTERN.findall(source_text)
 
                 # 检查是否有匹配项
                 if matches:
                     entry['translation_status'] = 7
-                    for match in matches:
-                        # 查找冒号的位置
-                        colon_index = match.find(':')
-                        if colon_index != -1: # 如果文本中存在冒号
-                            # 分割冒号左边的内容和冒号右边直到>的内容
-                            left = match[:colon_index].split('<SG')[-1].strip()
-                            right = match[colon_index+1:].split('>')[0].strip()
+                    for left, colon, right in matches:
+                        if colon: # 如果文本中存在冒号
+                            # 冒号左边的内容和冒号右边直到>的内容
+                            left = left.split('<SG')[-1].strip()
+                            right = right.strip()
                             # 检查右边字符量是否比左边字符量大N倍
                             if len(right) > len(left) * 15:
                                 entry['translation_status'] = 0